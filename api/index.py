@@ -1,73 +1,110 @@
-"""Vercel serverless function handler for Flask app."""
+"""Vercel serverless function handler for FastAPI app."""
 
-from flask import Flask, render_template, request, jsonify
+from fastapi import FastAPI, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel
+import asyncio
 import os
 import sys
-from detect_anomaly import CodeAnomalyDetector
+import threading
+import uvicorn
+from detect_anomaly import CodeAnomalyDetector, EmbeddingBatcher
 
-app = Flask(__name__, template_folder='templates', static_folder='static')
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+app = FastAPI()
+app.mount('/static', StaticFiles(directory=os.path.join(BASE_DIR, 'static')), name='static')
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, 'templates'))
+_detector_lock = threading.Lock()
 detector = None
+batcher = None
 training_complete = False
 
 
+class AnalyzeRequest(BaseModel):
+    """Body of an /analyze request."""
+    code: str = ''
+
+
 def initialize_detector():
-    """Initialize detector and train on normal files."""
-    global detector, training_complete
+    """Initialize detector and train on normal files, once per process."""
+    global detector, batcher, training_complete
     
-    if detector is None:
-        detector = CodeAnomalyDetector(semantic_weight=0.9, structural_weight=0.1)
+    with _detector_lock:
+        if detector is None:
+            detector = CodeAnomalyDetector(semantic_weight=0.9, structural_weight=0.1)
+            # Concurrent requests share forward passes through the batcher
+            batcher = EmbeddingBatcher(detector.embedder)
         
-    if not training_complete:
-        try:
-            detector.train_from_normal_files("normal_code")
-            training_complete = True
-        except Exception as e:
-            print(f"Warning: Could not train detector: {e}")
+        if not training_complete:
+            try:
+                detector.train_from_normal_files("normal_code", "anomalous_code")
+                training_complete = True
+            except Exception as e:
+                print(f"Warning: Could not train detector: {e}")
+
+
+# Load the model at import time so all requests (and preloaded gunicorn workers) share it
+initialize_detector()
+
 
+@app.exception_handler(RequestValidationError)
+async def invalid_request(request: Request, exc: RequestValidationError):
+    """Report malformed request bodies in the same {'error': ...} shape as other failures."""
+    return JSONResponse({'error': 'Invalid request: expected a JSON body with a "code" string'}, status_code=400)
 
-@app.route('/')
-def index():
+
+@app.get('/')
+async def index(request: Request):
     """Main page."""
-    return render_template('index.html')
+    return templates.TemplateResponse(request, 'index.html')
 
 
-@app.route('/analyze', methods=['POST'])
-def analyze():
+@app.post('/analyze')
+async def analyze(payload: AnalyzeRequest):
     """Analyze submitted code."""
     try:
-        data = request.json
-        code = data.get('code', '').strip()
+        code = payload.code.strip()
         
         if not code:
-            return jsonify({'error': 'Please paste some code to analyze'}), 400
+            return JSONResponse({'error': 'Please paste some code to analyze'}, status_code=400)
+        
+        if not training_complete:
+            return JSONResponse({'error': 'Detector failed to initialize'}, status_code=503)
         
-        # Initialize detector if needed
-        initialize_detector()
+        # Phase 2 runs on the batcher thread while phase 1 runs in the default executor;
+        # the event loop stays free to serve other requests while both are in progress
+        embedding_future = asyncio.wrap_future(batcher.submit(code))
         
         # Phase 1: Extract metrics (instant)
-        metrics = detector.extract_structural_metrics(code)
+        loop = asyncio.get_running_loop()
+        metrics = await loop.run_in_executor(None, detector.extract_structural_metrics, code)
         
         # Phase 2: Generate embedding (medium)
-        test_embedding = detector.embedder.get_embedding(code)
+        test_embedding = await embedding_future
         
         # Phase 3: Calculate score (instant)
-        similarity_score = detector.calculate_similarity(test_embedding)
-        
-        # Calculate final anomaly score
-        anomaly_score = (metrics['anomaly_score'] + similarity_score) / 2
+        scores = detector.score_embedding(test_embedding, metrics)
         
-        is_anomaly = anomaly_score > detector.anomaly_threshold
-        
-        return jsonify({
-            'anomaly_score': float(anomaly_score),
-            'is_anomaly': bool(is_anomaly),
-            'structural_metrics': metrics,
-            'similarity_score': float(similarity_score),
-            'threshold': float(detector.anomaly_threshold)
-        })
+        # Phase 4: Format results (instant)
+        return {
+            'anomaly_score': f"{scores['anomaly_score']:.3f}",
+            'classification': scores['classification'],
+            'functions': metrics['functions'],
+            'loops': metrics['loops'],
+            'if_statements': metrics['if_statements'],
+            'max_depth': metrics['max_depth'],
+            'semantic_score': f"{scores['semantic_score']:.3f}",
+            'structural_score': f"{scores['structural_score']:.3f}",
+            'threshold': '< 7 = NORMAL | >= 7 = ANOMALOUS'
+        }
+    
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return JSONResponse({'error': f'Error analyzing code: {str(e)}'}, status_code=500)
 
 
 if __name__ == '__main__':
-    app.run(debug=False)
+    uvicorn.run(app)
@@ -1,96 +1,118 @@
-"""Flask web application for Code Anomaly Detection."""
+"""FastAPI web application for Code Anomaly Detection."""
 
-from flask import Flask, render_template, request, jsonify
+from fastapi import FastAPI, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel
+import asyncio
 import os
 import sys
-from detect_anomaly import CodeAnomalyDetector
+import threading
+import uvicorn
+from detect_anomaly import CodeAnomalyDetector, EmbeddingBatcher
 
-app = Flask(__name__)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+app = FastAPI()
+app.mount('/static', StaticFiles(directory=os.path.join(BASE_DIR, 'static')), name='static')
+templates = Jinja2Templates(directory=os.path.join(BASE_DIR, 'templates'))
+_detector_lock = threading.Lock()
 detector = None
+batcher = None
 training_complete = False
 
 
+class AnalyzeRequest(BaseModel):
+    """Body of an /analyze request."""
+    code: str = ''
+
+
 def initialize_detector():
-    """Initialize detector and train on normal files."""
-    global detector, training_complete
+    """Initialize detector and train on normal files, once per process."""
+    global detector, batcher, training_complete
     
-    if detector is None:
-        detector = CodeAnomalyDetector(semantic_weight=0.9, structural_weight=0.1)
+    with _detector_lock:
+        if detector is None:
+            detector = CodeAnomalyDetector(semantic_weight=0.9, structural_weight=0.1)
+            # Concurrent requests share forward passes through the batcher
+            batcher = EmbeddingBatcher(detector.embedder)
         
-    if not training_complete:
-        detector.train_from_normal_files("normal_code")
-        training_complete = True
+        if not training_complete:
+            detector.train_from_normal_files("normal_code", "anomalous_code")
+            training_complete = True
+
+
+# Load the model at import time so all requests (and preloaded gunicorn workers) share it
+initialize_detector()
 
 
-@app.route('/')
-def index():
+@app.exception_handler(RequestValidationError)
+async def invalid_request(request: Request, exc: RequestValidationError):
+    """Report malformed request bodies in the same {'error': ...} shape as other failures."""
+    return JSONResponse({'error': 'Invalid request: expected a JSON body with a "code" string'}, status_code=400)
+
+
+@app.get('/')
+async def index(request: Request):
     """Main page."""
-    return render_template('index.html')
+    return templates.TemplateResponse(request, 'index.html')
 
 
-@app.route('/analyze', methods=['POST'])
-def analyze():
+@app.post('/analyze')
+async def analyze(payload: AnalyzeRequest):
     """Analyze submitted code."""
     try:
-        data = request.json
-        code = data.get('code', '').strip()
+        code = payload.code.strip()
         
         if not code:
-            return jsonify({'error': 'Please paste some code to analyze'}), 400
+            return JSONResponse({'error': 'Please paste some code to analyze'}, status_code=400)
         
-        # Initialize detector if needed
-        initialize_detector()
+        # Phase 2 runs on the batcher thread while phase 1 runs in the default executor;
+        # the event loop stays free to serve other requests while both are in progress
+        embedding_future = asyncio.wrap_future(batcher.submit(code))
         
         # Phase 1: Extract metrics (instant)
-        metrics = detector.extract_structural_metrics(code)
+        loop = asyncio.get_running_loop()
+        metrics = await loop.run_in_executor(None, detector.extract_structural_metrics, code)
         
         # Phase 2: Generate embedding (medium)
-        test_embedding = detector.embedder.get_embedding(code)
+        test_embedding = await embedding_future
         
         # Phase 3: Calculate score (instant)
-        from sklearn.metrics.pairwise import cosine_similarity
-        similarity = cosine_similarity(test_embedding, detector.normal_embedding)[0][0]
-        semantic_score = 1.0 - similarity
-        structural_score = detector.compute_structural_score(metrics)
-        
-        raw_score = detector.semantic_weight * semantic_score + detector.structural_weight * structural_score
-        anomaly_score = raw_score * 150.0
-        
-        if anomaly_score < 7:
-            classification = "NORMAL"
-        else:
-            classification = "ANOMALOUS"
+        scores = detector.score_embedding(test_embedding, metrics)
         
         # Phase 4: Format results (instant)
-        result = {
-            'anomaly_score': f"{anomaly_score:.3f}",
-            'classification': classification,
+        return {
+            'anomaly_score': f"{scores['anomaly_score']:.3f}",
+            'classification': scores['classification'],
             'functions': metrics['functions'],
             'loops': metrics['loops'],
             'if_statements': metrics['if_statements'],
             'max_depth': metrics['max_depth'],
-            'semantic_score': f"{semantic_score:.3f}",
-            'structural_score': f"{structural_score:.3f}",
+            'semantic_score': f"{scores['semantic_score']:.3f}",
+            'structural_score': f"{scores['structural_score']:.3f}",
             'threshold': '< 7 = NORMAL | >= 7 = ANOMALOUS'
         }
-        
-        return jsonify(result)
     
     except Exception as e:
-        return jsonify({'error': f'Error analyzing code: {str(e)}'}), 500
+        return JSONResponse({'error': f'Error analyzing code: {str(e)}'}, status_code=500)
 
 
-@app.route('/status', methods=['GET'])
-def status():
+@app.get('/status')
+async def status():
     """Check initialization status."""
-    global training_complete
     if training_complete:
-        return jsonify({'status': 'ready', 'message': 'Detector ready for analysis'})
+        return {'status': 'ready', 'message': 'Detector ready for analysis'}
     else:
-        return jsonify({'status': 'initializing', 'message': 'Initializing detector...'})
+        return {'status': 'initializing', 'message': 'Initializing detector...'}
 
 
 if __name__ == '__main__':
-    # Initialize on startup
-    initialize_detector()
-    app.run(debug=True, port=5000)
+    # Development server only. In production run gunicorn with uvicorn workers (gunicorn.conf.py):
+    #   gunicorn app:app
+    # or uvicorn directly (its worker count also comes from WEB_CONCURRENCY, which the app
+    # uses to split the CPU cores between workers):
+    #   WEB_CONCURRENCY=4 uvicorn app:app --loop uvloop --port 5000
+    uvicorn.run(app, port=5000)
@@ -5,102 +5,452 @@ Uses CodeBERT embeddings and structural metrics to detect anomalies in Python co
 
 import os
 import ast
+import mmap
+import time
+import queue
+import hashlib
+import threading
 import torch
 import numpy as np
-from typing import Dict, List, Tuple
-from transformers import AutoTokenizer, AutoModel
-from sklearn.metrics.pairwise import cosine_similarity
-
-
-class StructuralAnalyzer(ast.NodeVisitor):
-    """Extract structural metrics from Python code using AST."""
-    
-    def __init__(self):
-        self.function_count = 0
-        self.loop_count = 0
-        self.if_count = 0
-        self.max_depth = 0
-        self.current_depth = 0
-    
-    def visit_FunctionDef(self, node):
-        """Count function definitions."""
-        self.function_count += 1
-        self.generic_visit(node)
-    
-    def visit_For(self, node):
-        """Count for loops."""
-        self.loop_count += 1
-        self.generic_visit(node)
-    
-    def visit_While(self, node):
-        """Count while loops."""
-        self.loop_count += 1
-        self.generic_visit(node)
-    
-    def visit_If(self, node):
-        """Count if statements."""
-        self.if_count += 1
-        self.generic_visit(node)
-    
-    def generic_visit(self, node):
-        """Track nesting depth."""
-        self.current_depth += 1
-        self.max_depth = max(self.max_depth, self.current_depth)
-        super().generic_visit(node)
-        self.current_depth -= 1
-    
-    def get_metrics(self) -> Dict[str, int]:
-        """Return structural metrics."""
-        return {
-            'functions': self.function_count,
-            'loops': self.loop_count,
-            'if_statements': self.if_count,
-            'max_depth': self.max_depth
-        }
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from transformers import AutoTokenizer, AutoModel, AutoConfig
+
+
+try:
+    from fast_walk import walk_unordered
+except ImportError:  # fast-walk only ships for Python 3.13+; use the stdlib walker elsewhere
+    walk_unordered = ast.walk
+
+
+# Tag per counted node type: 0 = function, 1 = loop, 2 = if; everything else is 3
+NODE_TAG = {
+    ast.FunctionDef: 0, ast.AsyncFunctionDef: 0,
+    ast.For: 1, ast.AsyncFor: 1, ast.While: 1,
+    ast.If: 2
+}
+
+
+# Subtree heights of node types whose shape is fixed. These make up most of a typical
+# tree, so the depth walk adds their height instead of descending into them.
+LEAF_HEIGHT = {
+    cls: 1
+    for base in (ast.expr_context, ast.operator, ast.boolop, ast.unaryop, ast.cmpop)
+    for cls in base.__subclasses__()
+}
+LEAF_HEIGHT.update({ast.Constant: 1, ast.alias: 1, ast.Name: 2})
+
+
+def compute_max_depth(node: ast.AST) -> int:
+    """Return nesting depth of an AST, counting every node on the deepest path."""
+    # Explicit stack instead of recursion: no recursion limit and no frame per node
+    iter_child_nodes = ast.iter_child_nodes
+    leaf_height = LEAF_HEIGHT.get
+    stack = [(node, 1)]
+    max_depth = 0
+    while stack:
+        node, depth = stack.pop()
+        height = leaf_height(type(node))
+        if height is not None:
+            depth += height - 1
+            if depth > max_depth:
+                max_depth = depth
+            continue
+        if depth > max_depth:
+            max_depth = depth
+        stack.extend((child, depth + 1) for child in iter_child_nodes(node))
+    return max_depth
+
+
+try:
+    import onnxruntime
+except ImportError:  # onnxruntime not installed, PyTorch inference only
+    onnxruntime = None
+
+
+# 6-layer RoBERTa trained on code: about half the FLOPs of microsoft/codebert-base
+DEFAULT_MODEL_NAME = "huggingface/CodeBERTa-small-v1"
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_models")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "normal_baseline.npz")
+# Bump when the way the baseline is computed changes, so stale baseline files are ignored
+BASELINE_VERSION = 5
+TOKENS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "normal_tokens.pt")
+EMBEDDING_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "code-anomaly", "embeddings")
+# Scores >= ANOMALY_THRESHOLD (0-10 scale) are classified ANOMALOUS
+ANOMALY_THRESHOLD = 7.0
+# Raw-score multiplier used when no anomalous examples are available for calibration
+DEFAULT_SCORE_SCALE = 150.0
+
+
+def source_hash(code: str) -> str:
+    """Return the embedding cache key for a code string."""
+    return hashlib.blake2b(code.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def read_python_file(path: str) -> Tuple[str, str]:
+    """Return the UTF-8 text of a file and a blake2b digest of its bytes.
+    
+    The file is memory-mapped, so hashing and decoding read the page cache
+    directly instead of going through an intermediate bytes copy.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return '', hashlib.blake2b(b'').hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return str(mm, 'utf-8'), hashlib.blake2b(mm).hexdigest()
+
+
+def read_python_files(directory: str) -> List[Tuple[str, str, str]]:
+    """Read every .py file in directory as (filename, code, digest), sorted by name."""
+    with os.scandir(directory) as it:
+        entries = sorted((e for e in it if e.name.endswith('.py') and e.is_file()), key=lambda e: e.name)
+    
+    def read(entry: os.DirEntry) -> Optional[Tuple[str, str, str]]:
+        try:
+            return (entry.name,) + read_python_file(entry.path)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Could not read {entry.name}: {e}")
+            return None
+    
+    # Overlap the many small reads instead of paying for each open/read in turn
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        return [source for source in pool.map(read, entries) if source is not None]
+
+
+def quantize_int8(rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Symmetrically quantize each row to int8, returning the values and per-row scales."""
+    scales = np.maximum(np.abs(rows).max(axis=1), 1e-12) / 127.0
+    return np.round(rows / scales[:, np.newaxis]).astype(np.int8), scales.astype(np.float32)
+
+
+def dequantize_int8(values: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """Inverse of quantize_int8."""
+    return values.astype(np.float32) * scales[:, np.newaxis]
+
+
+def normalize_rows(rows: np.ndarray) -> np.ndarray:
+    """Scale each row to unit L2 length."""
+    return rows / np.maximum(np.linalg.norm(rows, axis=1, keepdims=True), 1e-12)
+
+
+def threads_per_process() -> int:
+    """Return the CPU threads one server process may use for inference.
+    
+    The cores are shared between the WEB_CONCURRENCY worker processes (set by
+    gunicorn.conf.py), so several workers do not oversubscribe the machine.
+    """
+    try:
+        workers = max(1, int(os.environ.get('WEB_CONCURRENCY', '1')))
+    except ValueError:
+        workers = 1
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def file_digest(path: str) -> str:
+    """Return the blake2b digest of a file's contents."""
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def onnx_model_path(model_name: str) -> str:
+    """Return where export_onnx.py writes the int8 ONNX export of a model."""
+    return os.path.join(ONNX_MODEL_DIR, model_name.replace('/', '--'), "model_int8.onnx")
 
 
 class CodeBERTEmbedder:
-    """Generate embeddings using CodeBERT model."""
+    """Generate embeddings using a CodeBERT-family model."""
+    
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, cache_dir: Optional[str] = EMBEDDING_CACHE_DIR,
+                 cache_size: int = 4096, batch_size: int = 16, onnx_path: Optional[str] = None):
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        
+        # Prefer the int8 ONNX export (see export_onnx.py) when it and onnxruntime are available
+        if onnx_path is None:
+            onnx_path = onnx_model_path(model_name)
+        if onnxruntime is not None and os.path.exists(onnx_path):
+            # The session itself is created per process in _prepare_runtime()
+            self.onnx_path = onnx_path
+            self.model = None
+            self.hidden_size = AutoConfig.from_pretrained(model_name).hidden_size
+            # Keyed on the file contents, so a baseline built in one checkout matches in another
+            self.backend = f"onnx:{file_digest(onnx_path)}"
+        else:
+            self.onnx_path = None
+            self.backend = "torch"
+            self.model = AutoModel.from_pretrained(model_name)
+            self.model.eval()
+            self.hidden_size = self.model.config.hidden_size
+            
+            # Inference only: turn off autograd once instead of entering no_grad() per call.
+            # Grad mode is thread-local, so also freeze the weights for batcher/worker threads.
+            self.model.requires_grad_(False)
+            torch.set_grad_enabled(False)
+        self.batch_size = batch_size
+        
+        self._session = None
+        self._session_inputs = None
+        self._inherited_sessions = []
+        self._runtime_pid = None
+        self._runtime_lock = threading.Lock()
+        
+        # In-memory LRU for every input; the on-disk .npy store (one directory per model and
+        # backend) only holds inputs embedded with persist=True, i.e. the training files
+        self.cache_dir = os.path.join(cache_dir, self.cache_namespace) if cache_dir else None
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
     
-    def __init__(self):
-        self.tokenizer = AutoTokenizer.from_pretrained("microsoft/codebert-base")
-        self.model = AutoModel.from_pretrained("microsoft/codebert-base")
-        self.model.eval()
+    @property
+    def cache_namespace(self) -> str:
+        """Directory name separating embeddings of different models and backends.
+        
+        int8 ONNX and fp32 PyTorch embeddings of the same model differ slightly,
+        so they must never be mixed.
+        """
+        if self.backend == "torch":
+            backend = "torch"
+        else:
+            backend = "onnx-" + hashlib.blake2b(self.backend.encode('utf-8'), digest_size=8).hexdigest()
+        return os.path.join(self.model_name.replace('/', '--'), backend)
     
     def get_embedding(self, code: str) -> np.ndarray:
-        """Generate embedding for Python code."""
-        inputs = self.tokenizer(
-            code,
-            return_tensors="pt",
-            truncation=True,
-            max_length=512
-        )
-        
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-        
-        # Mean pooling of token embeddings
-        embedding = outputs.last_hidden_state.mean(dim=1).cpu().numpy()
+        """Generate embedding for Python code, reusing cached results."""
+        return self.get_embeddings([code])
+    
+    def get_embeddings(self, codes: List[str], input_ids: Optional[List[List[int]]] = None,
+                       persist: bool = False) -> np.ndarray:
+        """Generate one L2-normalized embedding row per code string, batching cache misses.
+        
+        input_ids may hold the already tokenized codes (see tokenize()). With
+        persist=True the embeddings are also read from and written to cache_dir.
+        """
+        keys = [source_hash(code) for code in codes]
+        embeddings = [self._load_cached(key, persist) for key in keys]
+        
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            if input_ids is None:
+                missing_ids = self.tokenize([codes[i] for i in missing])
+            else:
+                missing_ids = [input_ids[i] for i in missing]
+            computed = self._embed_batch(missing_ids)
+            for i, embedding in zip(missing, computed):
+                embedding = embedding[np.newaxis, :]
+                self._store_cached(keys[i], embedding, persist)
+                embeddings[i] = embedding
+        
+        # Unit rows turn cosine similarity into a plain dot product
+        return normalize_rows(np.concatenate(embeddings, axis=0))
+    
+    def tokenize(self, codes: List[str]) -> List[List[int]]:
+        """Tokenize code strings to unpadded, truncated token id lists."""
+        return self.tokenizer(codes, truncation=True, max_length=512)['input_ids']
+    
+    def _embed_batch(self, input_ids: List[List[int]]) -> np.ndarray:
+        """Run the model over tokenized inputs in length-sorted batches."""
+        # Sorting by token count keeps similar lengths together, so little padding is wasted
+        order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+        embeddings = np.empty((len(input_ids), self.hidden_size), dtype=np.float32)
+        
+        for start in range(0, len(order), self.batch_size):
+            batch_order = order[start:start + self.batch_size]
+            inputs = self.tokenizer.pad(
+                {'input_ids': [input_ids[i] for i in batch_order]},
+                return_tensors="np"
+            )
+            hidden_states = self._run_model(inputs)
+            
+            # Mean pooling over real tokens only, ignoring padding
+            mask = inputs['attention_mask'][:, :, np.newaxis].astype(np.float32)
+            summed = (hidden_states * mask).sum(axis=1)
+            embeddings[batch_order] = summed / np.maximum(mask.sum(axis=1), 1.0)
+        
+        return embeddings
+    
+    def _run_model(self, inputs: Dict[str, np.ndarray]) -> np.ndarray:
+        """Return last hidden states for a padded batch as a float32 array."""
+        self._prepare_runtime()
+        if self._session is not None:
+            feed = {name: inputs[name].astype(np.int64) for name in self._session_inputs}
+            return self._session.run(None, feed)[0].astype(np.float32, copy=False)
+        
+        outputs = self.model(**{name: torch.from_numpy(value) for name, value in inputs.items()})
+        return outputs.last_hidden_state.cpu().numpy()
+    
+    def _prepare_runtime(self) -> None:
+        """Set up thread pools and the ONNX session for the current process.
+        
+        Thread pools do not survive fork, so preloaded gunicorn workers must
+        not reuse the ones created in the master.
+        """
+        if self._runtime_pid == os.getpid():
+            return
+        with self._runtime_lock:
+            if self._runtime_pid == os.getpid():
+                return
+            threads = threads_per_process()
+            if self.onnx_path is not None:
+                if self._session is not None:
+                    # Never destroy a session inherited through fork: its destructor would
+                    # try to join pool threads that only exist in the parent
+                    self._inherited_sessions.append(self._session)
+                sess_options = onnxruntime.SessionOptions()
+                sess_options.intra_op_num_threads = threads
+                self._session = onnxruntime.InferenceSession(
+                    self.onnx_path, sess_options, providers=["CPUExecutionProvider"]
+                )
+                self._session_inputs = [i.name for i in self._session.get_inputs()]
+            else:
+                torch.set_num_threads(threads)
+            self._runtime_pid = os.getpid()
+    
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+    
+    def _load_cached(self, key: str, persist: bool) -> Optional[np.ndarray]:
+        """Look up an embedding in memory, then on disk if persist is set."""
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        
+        if not persist or self.cache_dir is None:
+            return None
+        try:
+            embedding = np.load(self._cache_path(key))
+        except (OSError, ValueError):
+            return None
+        self._remember(key, embedding)
         return embedding
+    
+    def _store_cached(self, key: str, embedding: np.ndarray, persist: bool) -> None:
+        """Save an embedding in memory and, if persist is set, on disk."""
+        self._remember(key, embedding)
+        
+        if not persist or self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._cache_path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, embedding)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: Could not write embedding cache: {e}")
+    
+    def _remember(self, key: str, embedding: np.ndarray) -> None:
+        with self._cache_lock:
+            self._cache[key] = embedding
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+class EmbeddingBatcher:
+    """Group concurrent get_embedding calls into shared batched forward passes.
+    
+    Requests wait up to max_latency seconds for others to arrive, then up to
+    batch_size of them are embedded with one get_embeddings call.
+    """
+    
+    def __init__(self, embedder: CodeBERTEmbedder, batch_size: int = 16, max_latency: float = 0.01):
+        self.embedder = embedder
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+    
+    def submit(self, code: str) -> Future:
+        """Queue code for embedding and return a future for its (1, dim) embedding."""
+        future = Future()
+        self._get_queue().put((code, future))
+        return future
+    
+    def _get_queue(self) -> queue.Queue:
+        # Threads do not survive fork, so start a worker per process (e.g. preloaded gunicorn workers)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+            return self._queue
+    
+    def _run(self, requests: queue.Queue) -> None:
+        while True:
+            batch = self._next_batch(requests)
+            try:
+                # Claim each future; those already cancelled by their caller (e.g. an
+                # awaiting request that timed out) are dropped instead of embedded
+                batch = [(code, future) for code, future in batch if future.set_running_or_notify_cancel()]
+                if batch:
+                    self._embed_batch(batch)
+            except Exception as e:
+                # The worker must outlive any single batch, or every later submit() would hang
+                print(f"Warning: Embedding batch failed: {e}")
+    
+    def _next_batch(self, requests: queue.Queue) -> List[Tuple[str, Future]]:
+        """Block for one request, then collect more until batch_size or max_latency."""
+        batch = [requests.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _embed_batch(self, batch: List[Tuple[str, Future]]) -> None:
+        """Embed a batch of claimed requests and resolve their futures."""
+        try:
+            embeddings = self.embedder.get_embeddings([code for code, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        
+        for i, (_, future) in enumerate(batch):
+            future.set_result(embeddings[i:i + 1])
 
 
 class CodeAnomalyDetector:
     """Detect anomalies in Python code using semantic and structural analysis."""
     
-    def __init__(self, semantic_weight: float = 0.6, structural_weight: float = 0.4):
-        self.embedder = CodeBERTEmbedder()
+    def __init__(self, semantic_weight: float = 0.6, structural_weight: float = 0.4,
+                 model_name: str = DEFAULT_MODEL_NAME, baseline_path: Optional[str] = BASELINE_PATH,
+                 tokens_path: Optional[str] = TOKENS_PATH):
+        self.embedder = CodeBERTEmbedder(model_name=model_name)
         self.semantic_weight = semantic_weight
         self.structural_weight = structural_weight
-        self.normal_embedding = None
+        self.baseline_path = baseline_path
+        self.tokens_path = tokens_path
+        # Unit-length embeddings of every normal file, one row each
+        self.normal_bank = None
         self.normal_metrics = None
+        # Maps the raw weighted score onto the 0-10 scale; calibrated during training
+        self.score_scale = DEFAULT_SCORE_SCALE
     
     def extract_structural_metrics(self, code: str) -> Dict[str, int]:
         """Extract structural metrics from code."""
         try:
             tree = ast.parse(code)
-            analyzer = StructuralAnalyzer()
-            analyzer.visit(tree)
-            return analyzer.get_metrics()
+            tags = np.fromiter((NODE_TAG.get(type(n), 3) for n in walk_unordered(tree)), dtype=np.int8)
+            counts = np.bincount(tags, minlength=4)
+            return {
+                'functions': int(counts[0]),
+                'loops': int(counts[1]),
+                'if_statements': int(counts[2]),
+                'max_depth': compute_max_depth(tree)
+            }
         except SyntaxError:
             return {
                 'functions': 0,
@@ -125,69 +475,221 @@ class CodeAnomalyDetector:
         structural_score = float(np.std(normalized))
         return min(structural_score, 1.0)
     
-    def train_from_normal_files(self, directory: str) -> None:
-        """Compute baseline from normal code files."""
-        embeddings = []
+    def train_from_normal_files(self, directory: str, anomalous_directory: Optional[str] = None) -> None:
+        """Compute baseline from normal code files.
+        
+        When anomalous_directory is given and readable, its files are used to calibrate
+        score_scale so that the threshold of 7 separates them from the normal
+        files. The result is saved to baseline_path and reused as long as the
+        files and the model are unchanged, skipping the model entirely.
+        """
+        sources = read_python_files(directory)
+        anomalous_sources = []
+        if anomalous_directory:
+            try:
+                anomalous_sources = read_python_files(anomalous_directory)
+            except OSError as e:
+                print(f"Warning: Could not read {anomalous_directory}: {e}")
+            if not anomalous_sources:
+                print("Warning: No anomalous files to calibrate against, using the default score scale")
+        sources_hash = self._sources_hash(sources)
+        dir_hash = hashlib.blake2b(
+            f"{BASELINE_VERSION}:{self.semantic_weight}:{self.structural_weight}:{sources_hash}:"
+            f"{self._sources_hash(anomalous_sources)}".encode('utf-8')
+        ).hexdigest()
+        if self._load_baseline(dir_hash):
+            return
+        
+        codes = []
+        structural_scores = []
         all_metrics = {'functions': [], 'loops': [], 'if_statements': [], 'max_depth': []}
         
-        for filename in os.listdir(directory):
-            if filename.endswith('.py'):
-                filepath = os.path.join(directory, filename)
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        code = f.read()
-                    
-                    embedding = self.embedder.get_embedding(code)
-                    embeddings.append(embedding)
-                    
-                    metrics = self.extract_structural_metrics(code)
-                    for key in all_metrics:
-                        all_metrics[key].append(metrics[key])
-                
-                except Exception as e:
-                    print(f"Warning: Could not process {filename}: {e}")
+        for filename, code, _ in sources:
+            try:
+                metrics = self.extract_structural_metrics(code)
+                for key in all_metrics:
+                    all_metrics[key].append(metrics[key])
+                structural_scores.append(self.compute_structural_score(metrics))
+                codes.append(code)
+            
+            except Exception as e:
+                print(f"Warning: Could not process {filename}: {e}")
+        
+        if not codes:
+            raise ValueError(f"No Python files could be read from {directory}")
         
-        # Compute mean embedding
-        self.normal_embedding = np.mean(embeddings, axis=0)
+        # Token ids are keyed on the sources hash alone, so they outlive BASELINE_VERSION bumps
+        input_ids = self._load_tokens(sources_hash)
+        if input_ids is None:
+            input_ids = self.embedder.tokenize(codes)
+            self._save_tokens(sources_hash, input_ids)
+        
+        # Embed every file in batched forward passes and keep them all as the reference bank.
+        # Go through the int8 form here too, so a fresh bank matches the one loaded from disk.
+        embeddings = self.embedder.get_embeddings(codes, input_ids, persist=True)
+        bank_int8, bank_scales = quantize_int8(embeddings)
+        self.normal_bank = normalize_rows(dequantize_int8(bank_int8, bank_scales))
         
         # Compute mean metrics
         self.normal_metrics = {
             key: np.mean(values) if values else 0
             for key, values in all_metrics.items()
         }
+        
+        self.score_scale = DEFAULT_SCORE_SCALE
+        if anomalous_sources:
+            self.score_scale = self._calibrate_score_scale(np.array(structural_scores), anomalous_sources)
+        
+        self._save_baseline(dir_hash, bank_int8, bank_scales)
     
-    def detect_anomaly(self, code: str) -> Tuple[float, str]:
-        """Detect anomaly and return score and classification.
+    def _calibrate_score_scale(self, normal_structural: np.ndarray,
+                               anomalous_sources: List[Tuple[str, str, str]]) -> float:
+        """Pick score_scale so that ANOMALY_THRESHOLD best separates normal from anomalous files.
         
-        Score ranges (0-10 scale):
-        - < 2.5: NORMAL
-        - >= 2.5: ANOMALOUS
+        Each normal file is scored against the bank without itself (leave-one-out),
+        each anomalous file against the whole bank. The raw-score cut with the best
+        balanced accuracy is mapped onto ANOMALY_THRESHOLD.
         """
-        if self.normal_embedding is None:
-            raise ValueError("Model must be trained first using train_from_normal_files()")
+        anomalous_codes = [code for _, code, _ in anomalous_sources]
+        anomalous_embeddings = self.embedder.get_embeddings(anomalous_codes, persist=True)
+        anomalous_structural = np.array([
+            self.compute_structural_score(self.extract_structural_metrics(code))
+            for code in anomalous_codes
+        ])
         
-        # Get semantic embedding
-        test_embedding = self.embedder.get_embedding(code)
+        if len(self.normal_bank) < 2:
+            return DEFAULT_SCORE_SCALE
+        similarities = self.normal_bank @ self.normal_bank.T
+        np.fill_diagonal(similarities, -np.inf)
+        normal_raw = (self.semantic_weight * (1.0 - similarities.max(axis=1))
+                      + self.structural_weight * normal_structural)
+        anomalous_raw = (self.semantic_weight * (1.0 - (self.normal_bank @ anomalous_embeddings.T).max(axis=0))
+                         + self.structural_weight * anomalous_structural)
+        
+        # Candidate cuts lie halfway between neighbouring distinct raw scores
+        values = np.unique(np.concatenate([normal_raw, anomalous_raw]))
+        cuts = (values[:-1] + values[1:]) / 2.0
+        cuts = cuts[cuts > 0]
+        if len(cuts) == 0:
+            return DEFAULT_SCORE_SCALE
+        true_negative_rate = (normal_raw[np.newaxis, :] < cuts[:, np.newaxis]).mean(axis=1)
+        true_positive_rate = (anomalous_raw[np.newaxis, :] >= cuts[:, np.newaxis]).mean(axis=1)
+        best = int(np.argmax(true_negative_rate + true_positive_rate))
+        print(f"Calibrated threshold: {true_negative_rate[best]:.1%} of normal and "
+              f"{true_positive_rate[best]:.1%} of anomalous files classified correctly")
+        return float(ANOMALY_THRESHOLD / cuts[best])
+    
+    def _sources_hash(self, sources: List[Tuple[str, str, str]]) -> str:
+        """Hash the training files together with the model name and inference backend."""
+        digest = hashlib.blake2b(f"{self.embedder.model_name}\0{self.embedder.backend}".encode('utf-8'))
+        for filename, _, file_digest in sources:
+            digest.update(f"\0{filename}\0{file_digest}".encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _load_baseline(self, dir_hash: str) -> bool:
+        """Load a saved baseline if it was computed from the same files and model."""
+        if self.baseline_path is None:
+            return False
+        try:
+            with np.load(self.baseline_path) as baseline:
+                if str(baseline['dir_hash']) != dir_hash:
+                    return False
+                self.normal_bank = normalize_rows(dequantize_int8(baseline['bank_int8'], baseline['bank_scales']))
+                self.score_scale = float(baseline['score_scale'])
+                self.normal_metrics = {
+                    key[len('metric_'):]: float(baseline[key])
+                    for key in baseline.files if key.startswith('metric_')
+                }
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+    
+    def _save_baseline(self, dir_hash: str, bank_int8: np.ndarray, bank_scales: np.ndarray) -> None:
+        """Write the current baseline to baseline_path.
         
-        # Compute semantic distance (0-1, higher = more anomalous)
-        similarity = cosine_similarity(test_embedding, self.normal_embedding)[0][0]
+        The bank is stored as int8, a quarter of its float32 size.
+        """
+        if self.baseline_path is None:
+            return
+        try:
+            tmp_path = f"{self.baseline_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    dir_hash=dir_hash,
+                    bank_int8=bank_int8,
+                    bank_scales=bank_scales,
+                    score_scale=self.score_scale,
+                    **{f"metric_{key}": value for key, value in self.normal_metrics.items()}
+                )
+            os.replace(tmp_path, self.baseline_path)
+        except OSError as e:
+            print(f"Warning: Could not save baseline: {e}")
+    
+    def _load_tokens(self, sources_hash: str) -> Optional[List[List[int]]]:
+        """Load token ids saved for the same training files and model."""
+        if self.tokens_path is None:
+            return None
+        try:
+            saved = torch.load(self.tokens_path, weights_only=True)
+        except Exception:
+            return None
+        if not isinstance(saved, dict) or saved.get('sources_hash') != sources_hash:
+            return None
+        return saved['input_ids']
+    
+    def _save_tokens(self, sources_hash: str, input_ids: List[List[int]]) -> None:
+        """Write token ids for the training files to tokens_path."""
+        if self.tokens_path is None:
+            return
+        try:
+            tmp_path = f"{self.tokens_path}.{os.getpid()}.tmp"
+            torch.save({'sources_hash': sources_hash, 'input_ids': input_ids}, tmp_path)
+            os.replace(tmp_path, self.tokens_path)
+        except OSError as e:
+            print(f"Warning: Could not save training tokens: {e}")
+    
+    def score_embedding(self, test_embedding: np.ndarray, metrics: Dict[str, int]) -> Dict:
+        """Combine semantic and structural scores for an embedded code sample."""
+        if self.normal_bank is None:
+            raise ValueError("Model must be trained first using train_from_normal_files()")
+        
+        # Compute semantic distance (0-1, higher = more anomalous) to the nearest normal file.
+        # All rows are unit length, so one matrix-vector product gives every cosine similarity.
+        similarities = self.normal_bank @ np.ravel(test_embedding).astype(np.float32)
+        similarity = float(similarities.max())
         semantic_score = 1.0 - similarity
         
-        # Get structural metrics
-        metrics = self.extract_structural_metrics(code)
         structural_score = self.compute_structural_score(metrics)
         
         # Combine scores and scale to 0-10 range
         raw_score = self.semantic_weight * semantic_score + self.structural_weight * structural_score
-        anomaly_score = raw_score * 150.0  # Very aggressive scaling to push scores to extremes
+        anomaly_score = raw_score * self.score_scale
         
         # Classify based on threshold
-        if anomaly_score < 7:
+        if anomaly_score < ANOMALY_THRESHOLD:
             classification = "NORMAL"
         else:
             classification = "ANOMALOUS"
         
-        return anomaly_score, classification
+        return {
+            'anomaly_score': anomaly_score,
+            'classification': classification,
+            'semantic_score': semantic_score,
+            'structural_score': structural_score
+        }
+    
+    def detect_anomaly(self, code: str) -> Tuple[float, str]:
+        """Detect anomaly and return score and classification.
+        
+        Score ranges (0-10 scale):
+        - < 7: NORMAL
+        - >= 7: ANOMALOUS
+        """
+        test_embedding = self.embedder.get_embedding(code)
+        metrics = self.extract_structural_metrics(code)
+        result = self.score_embedding(test_embedding, metrics)
+        return result['anomaly_score'], result['classification']
     
     def analyze_directory(self, directory: str) -> List[Dict]:
         """Analyze all Python files in directory."""
@@ -197,28 +699,23 @@ class CodeAnomalyDetector:
             print(f"Directory not found: {directory}")
             return results
         
-        for filename in sorted(os.listdir(directory)):
-            if filename.endswith('.py'):
-                filepath = os.path.join(directory, filename)
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        code = f.read()
-                    
-                    score, classification = self.detect_anomaly(code)
-                    metrics = self.extract_structural_metrics(code)
-                    
-                    results.append({
-                        'File': filename,
-                        'Anomaly Score': f"{score:.3f}",
-                        'Classification': classification,
-                        'Functions': metrics['functions'],
-                        'Loops': metrics['loops'],
-                        'If Statements': metrics['if_statements'],
-                        'Max Depth': metrics['max_depth']
-                    })
+        for filename, code, _ in read_python_files(directory):
+            try:
+                score, classification = self.detect_anomaly(code)
+                metrics = self.extract_structural_metrics(code)
                 
-                except Exception as e:
-                    print(f"Error processing {filename}: {e}")
+                results.append({
+                    'File': filename,
+                    'Anomaly Score': f"{score:.3f}",
+                    'Classification': classification,
+                    'Functions': metrics['functions'],
+                    'Loops': metrics['loops'],
+                    'If Statements': metrics['if_statements'],
+                    'Max Depth': metrics['max_depth']
+                })
+            
+            except Exception as e:
+                print(f"Error processing {filename}: {e}")
         
         return results
     
@@ -267,7 +764,7 @@ def main():
     
     # Train on normal code
     print("Training on normal code files...")
-    detector.train_from_normal_files("normal_code")
+    detector.train_from_normal_files("normal_code", "anomalous_code")
     print(f"[OK] Training complete. Normal baseline embedding computed.\n")
     
     # Analyze ONLY test code
@@ -0,0 +1,41 @@
+"""
+Export the embedding model to ONNX and quantize its weights to int8.
+CodeBERTEmbedder picks up the quantized model automatically when onnxruntime is installed.
+
+Usage:
+    pip install optimum[onnxruntime]
+    python export_onnx.py [model_name]
+"""
+
+import os
+import sys
+import tempfile
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+from onnxruntime.quantization import quantize_dynamic, QuantType
+from detect_anomaly import DEFAULT_MODEL_NAME, onnx_model_path
+
+
+def export_onnx(model_name: str = DEFAULT_MODEL_NAME) -> None:
+    """Export model to ONNX and write a dynamically int8-quantized copy of it.
+    
+    The fp32 export only lives in a temporary directory; only the int8 model is kept.
+    """
+    output_path = onnx_model_path(model_name)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    
+    with tempfile.TemporaryDirectory() as export_dir:
+        print(f"Exporting {model_name} to ONNX...")
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        model.save_pretrained(export_dir)
+        
+        print("Quantizing weights to int8...")
+        quantize_dynamic(
+            os.path.join(export_dir, "model.onnx"),
+            output_path,
+            weight_type=QuantType.QInt8
+        )
+    print(f"[OK] Quantized model written to {output_path}")
+
+
+if __name__ == "__main__":
+    export_onnx(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_MODEL_NAME)
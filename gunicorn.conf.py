@@ -0,0 +1,14 @@
+"""Gunicorn configuration for the FastAPI app: gunicorn app:app"""
+
+import os
+
+wsgi_app = "app:app"
+bind = "0.0.0.0:5000"
+
+# Import app.py (and load the model) once in the master; forked workers share it copy-on-write
+preload_app = True
+
+# Each worker runs its own asyncio event loop (uvloop when installed) on its own core.
+# WEB_CONCURRENCY is exported so the app splits its inference threads across the workers.
+workers = int(os.environ.setdefault("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"